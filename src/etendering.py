@@ -9,6 +9,8 @@ import re
 import boto3
 import glob
 
+from utils import data_extension, find_data_file
+
 '''COLORED LOGGING'''
 BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = range(8)
 
@@ -74,7 +76,7 @@ def write_data_csv(df, wordkey, schema, **config):
     Write data into raw folder.
     """
 	logger.info('Writting dataset into ' + schema + '...')
-	df.to_csv(config['ROOT_PATH'] + config['DATA_PATH'] + '/' + schema + '/' + wordkey + '.csv')
+	df.to_csv(config['ROOT_PATH'] + config['DATA_PATH'] + '/' + schema + '/' + wordkey + '.csv' + data_extension(config))
 
 def write_data_json(df, wordkey, schema, **config):
 	"""
@@ -82,7 +84,7 @@ def write_data_json(df, wordkey, schema, **config):
     """
 	logger.info('Writting dataset into ' + schema + '...')
 	df = df.reset_index()
-	df.to_json(config['ROOT_PATH'] + config['DATA_PATH'] + '/' + schema + '/' + wordkey + '.json')
+	df.to_json(config['ROOT_PATH'] + config['DATA_PATH'] + '/' + schema + '/' + wordkey + '.json' + data_extension(config))
 
 
 def read_data_csv(wordkey, schema, **config):
@@ -90,7 +92,7 @@ def read_data_csv(wordkey, schema, **config):
     Write data into raw folder.
     """
 	logger.info('Reading dataset: ' +  wordkey + ' from ' + schema + '...')
-	df = pd.read_csv(config['ROOT_PATH'] + config['DATA_PATH'] + '/' + schema + '/' + wordkey + '.csv')
+	df = pd.read_csv(find_data_file(config['ROOT_PATH'] + config['DATA_PATH'] + '/' + schema + '/' + wordkey + '.csv', config))
 	return df
 
 def read_data_json(wordkey, schema, **config):
@@ -98,5 +100,5 @@ def read_data_json(wordkey, schema, **config):
     Write data into raw folder.
     """
 	logger.info('Reading dataset: ' +  wordkey + ' from ' + schema + '...')
-	df = pd.read_json(config['ROOT_PATH'] + config['DATA_PATH'] + '/' + schema + '/' + wordkey + '.json')
+	df = pd.read_json(find_data_file(config['ROOT_PATH'] + config['DATA_PATH'] + '/' + schema + '/' + wordkey + '.json', config))
 	return df
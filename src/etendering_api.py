@@ -0,0 +1,208 @@
+import collections
+import json
+import os
+import threading
+import pandas as pd
+import yaml
+import numpy as np
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+# Open yaml
+with open('../config_file.yaml', 'r') as f:
+    configs = yaml.load(f)
+
+import sys
+sys.path.insert(0, configs['ROOT_PATH'] + configs['UTILS_PATH'])
+
+from utils import *
+
+SYSTEMS = ['VIS', 'Eurodac', 'SIS I', 'SIS II', 'Entry Exit System']
+
+# CPV codes are read as strings, keeping leading zeros (03000000)
+CPV_COLUMNS = {'cpv_code': str, 'cpv_codes': str, 'cpv_division': str,
+               'cpv_group': str, 'cpv_class': str, 'cpv_category': str}
+
+
+class DataStore:
+    """
+    Cleaned contracts, contractors and graph of every agency, loaded once
+    and indexed by contractor, year, agency, system and CPV division.
+    Files are reloaded when the pipeline rewrites them.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.agencies = config.get('AGENCIES', ['eulisa', 'frontex'])
+        self.lock = threading.Lock()
+        self.cache_size = int(config.get('API_CACHE_SIZE', 256))
+        self.mtimes = {}
+        self.load()
+
+    def base_paths(self):
+        paths = {}
+        for agency in self.agencies:
+            for table in ['contracts', 'contractors', 'graph']:
+                paths[(table, agency)] = '..' + self.config['DATA_PATH'] + '/etendering_' + table + '_' + agency + '.csv'
+        return paths
+
+    def candidates(self):
+        return sorted(c for path in self.base_paths().values() for c in data_file_candidates(path))
+
+    def load(self):
+        logger.info('Loading datasets.')
+        tables = {'contracts': [], 'contractors': [], 'graph': []}
+        self.mtimes = {}
+        self.loaded_candidates = self.candidates()
+        for (table, agency), base_path in self.base_paths().items():
+            path = find_data_file(base_path, self.config)
+            if not os.path.exists(path):
+                logger.warning('Missing dataset: ' + path)
+                continue
+            self.mtimes[path] = os.path.getmtime(path)
+            df = pd.read_csv(path, dtype=CPV_COLUMNS)
+            df['agency'] = agency
+            tables[table].append(df)
+
+        self.contracts, self.contractors, self.graph = [pd.concat(tables[t], ignore_index=True) if tables[t] else pd.DataFrame()
+                                                         for t in ['contracts', 'contractors', 'graph']]
+        for df in [self.contracts, self.contractors]:
+            if 'cpv' in df:
+                df['cpv_division'] = [c[0][:2] + '000000' if c else 'NA' for c in map(parse_cpv_codes, df['cpv'])]
+
+        # Row positions of the contractors table, by key
+        self.indexes = {}
+        for column in ['contractors_clean', 'year', 'agency', 'cpv_division']:
+            if column in self.contractors:
+                self.indexes[column] = self.contractors.groupby(column).indices
+        for system in SYSTEMS:
+            if system in self.contractors:
+                self.indexes[system] = np.flatnonzero((self.contractors[system] == True).values)
+        self.contracts_agency = self.contracts.groupby('agency').indices if len(self.contracts) else {}
+        self.graph_agency = self.graph.groupby('agency').indices if len(self.graph) else {}
+        self.cache = collections.OrderedDict()
+
+    def reload_if_changed(self):
+        """
+        Reload if a loaded file changed or if versions of the files appeared or disappeared.
+        """
+        if self.candidates() != self.loaded_candidates or \
+           any(os.path.getmtime(p) != mtime for p, mtime in self.mtimes.items()):
+            self.load()
+
+    def select(self, params):
+        """
+        Rows of the contractors table matching the filters
+        agency, contractor, year, system and cpv.
+        """
+        rows = None
+        filters = [('agency', 'agency'), ('contractor', 'contractors_clean'), ('year', 'year'), ('cpv', 'cpv_division')]
+        for param, column in filters:
+            if param in params:
+                key = int(params[param]) if column == 'year' else params[param]
+                if column == 'cpv_division':
+                    key = key[:2] + '000000'
+                found = self.indexes.get(column, {}).get(key, np.array([], dtype=int))
+                rows = found if rows is None else np.intersect1d(rows, found)
+        if 'system' in params:
+            if params['system'] not in SYSTEMS:
+                raise ValueError('Unknown system ' + repr(params['system']) + '. Available: ' + ', '.join(SYSTEMS))
+            found = self.indexes.get(params['system'], np.array([], dtype=int))
+            rows = found if rows is None else np.intersect1d(rows, found)
+        if rows is None:
+            return self.contractors
+        return self.contractors.iloc[rows]
+
+    def query(self, endpoint, params):
+        with self.lock:
+            self.reload_if_changed()
+            # Least recently used responses are dropped beyond API_CACHE_SIZE
+            key = (endpoint, tuple(sorted(params.items())))
+            if key in self.cache:
+                self.cache.move_to_end(key)
+            else:
+                self.cache[key] = ENDPOINTS[endpoint](self, params)
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            return self.cache[key]
+
+
+def top_contractors(store, params):
+    df = store.select(params)
+    n = int(params.get('n', 10))
+    if params.get('by', 'value') == 'count':
+        counts = df['contractors_clean'].value_counts().head(n)
+        return [{'contractor': c, 'count': int(v)} for c, v in counts.items()]
+    values = df.groupby('contractors_clean')['contractors_total_value_clean'].sum().sort_values(ascending=False).head(n)
+    return [{'contractor': c, 'value': float(v)} for c, v in values.items()]
+
+def top_contracts(store, params):
+    df = store.select(params).drop_duplicates(subset=['id'])
+    n = int(params.get('n', 10))
+    values = df.groupby('id')['contractors_total_value_clean'].sum().sort_values(ascending=False).head(n)
+    return [{'id': i, 'value': float(v)} for i, v in values.items()]
+
+def year_value(store, params):
+    df = store.contracts
+    if 'agency' in params:
+        df = df.iloc[store.contracts_agency.get(params['agency'], [])]
+    values = df.drop_duplicates(subset=['id']).groupby('year')['object_total_value_clean'].sum()
+    return [{'year': int(y), 'value': float(v)} for y, v in values.items()]
+
+def system(store, params):
+    df = store.select(params)
+    return {'companies': sorted(df['contractors_clean'].dropna().unique().tolist()),
+            'investment': float(df['contractors_total_value_clean'].sum())}
+
+def contracts(store, params):
+    df = store.select(params)
+    return json.loads(df.to_json(orient='records'))
+
+def graph(store, params):
+    df = store.graph
+    if 'agency' in params:
+        df = df.iloc[store.graph_agency.get(params['agency'], [])]
+    return json.loads(df.to_json(orient='records'))
+
+ENDPOINTS = {
+    '/top_contractors': top_contractors,
+    '/top_contracts': top_contracts,
+    '/year_value': year_value,
+    '/system': system,
+    '/contracts': contracts,
+    '/graph': graph
+}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    store = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path not in ENDPOINTS:
+            self.respond(404, {'error': 'Unknown endpoint. Available: ' + ', '.join(ENDPOINTS)})
+            return
+        try:
+            self.respond(200, self.store.query(url.path, params))
+        except (KeyError, ValueError) as e:
+            self.respond(400, {'error': str(e)})
+
+    def respond(self, status, body):
+        payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+if __name__== "__main__":
+    QueryHandler.store = DataStore(configs)
+    port = int(configs.get('API_PORT', 8000))
+    logger.info('Serving queries on http://localhost:' + str(port))
+    ThreadingHTTPServer(('localhost', port), QueryHandler).serve_forever()
@@ -16,13 +16,28 @@ sys.path.insert(0, configs['ROOT_PATH'] + configs['UTILS_PATH'])
 from utils import *
 
 if __name__== "__main__":
-    # Read raw document
-    corpus = read_corpus(configs)
+    # Read raw document (streamed, possibly compressed)
+    corpus_raw_list = iter_corpus(configs)
+
+    # CPV hierarchy and categories (optional)
+    cpv_index = None
+    if 'CPV_PATH' in configs:
+        logger.info('Loading CPV hierarchy.')
+        cpv_index = load_cpv_index(configs['ROOT_PATH'] + configs['CPV_PATH'])
+    cpv_categories = read_cpv_categories(configs)
 
     # Structure the document into a JSON file
     # Note that we only extract info of 'Contract award notice' documents
-    corpus_raw_list = corpus.split('I.II.')
-    contracts_json = [make_json(c) for c in corpus_raw_list if re.search('Contract award notice', c)]
+    contracts_json = (make_json(c) for c in corpus_raw_list if re.search('Contract award notice', c))
+
+    # Chunked mode: tabulate batches of contracts, bounding the memory used
+    if configs.get('CHUNKSIZE'):
+        tabulate_chunked(contracts_json, configs, int(configs['CHUNKSIZE']),
+                         cpv_index, cpv_categories, configs.get('NAME_NORMALIZATION'))
+        logger.info('Data successfully cleaned.')
+        sys.exit(0)
+
+    contracts_json = list(contracts_json)
     write_json(contracts_json, configs)
 
     # From JSON to dataFrame
@@ -30,13 +45,13 @@ if __name__== "__main__":
     logger.info('Writing CSV file.')
 
     # Clean DataFrame
-    df_clean = clean_df(df)
-    df_clean.to_csv('..' + configs['DATA_PATH'] + '/etendering_contracts_' + configs['AGENCY'] + '.csv', index=False)
+    df_clean = clean_df(df, cpv_index, cpv_categories)
+    df_clean.to_csv('..' + configs['DATA_PATH'] + '/etendering_contracts_' + configs['AGENCY'] + '.csv' + data_extension(configs), index=False)
 
     # Some contracts are duplicated because they got more than one contractor.
     # We will create another dataset with 1 contract per contractor.
     df_contractors = create_df_contractors(contracts_json, df_clean)
-    df_contractors_clean = clean_df_contractors(df_contractors)
+    df_contractors_clean = clean_df_contractors(df_contractors, configs.get('NAME_NORMALIZATION'))
     logger.info('Data successfully cleaned. Writing the clean file.')
 
-    df_contractors_clean.to_csv('..' + configs['DATA_PATH'] + '/etendering_contractors_' + configs['AGENCY'] + '.csv', index=False)
+    df_contractors_clean.to_csv('..' + configs['DATA_PATH'] + '/etendering_contractors_' + configs['AGENCY'] + '.csv' + data_extension(configs), index=False)
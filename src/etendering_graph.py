@@ -18,7 +18,7 @@ sys.path.insert(0, configs['ROOT_PATH'] + configs['UTILS_PATH'])
 from utils import *
 
 if __name__== "__main__":
-    df_contractors = pd.read_csv('..' + configs['DATA_PATH'] + '/etendering_contractors_' + configs['AGENCY'] + '.csv')
+    df_contractors = pd.read_csv(find_data_file('..' + configs['DATA_PATH'] + '/etendering_contractors_' + configs['AGENCY'] + '.csv', configs))
 
     # Build graph DataFrame
     logger.info("Buiding graph dataset.")
@@ -30,11 +30,45 @@ if __name__== "__main__":
     ids, sources, targets, weights = df_to_graph(df_contractors, ids, sources, targets, weights)
     df_graph = pd.DataFrame([ids, sources, targets, weights]).T
     df_graph.columns = ['id_contract', 'source', 'target', 'weight']
+
+    # Normalize the names of the nodes (source and target together)
+    names = normalize_names(pd.concat([df_graph['source'], df_graph['target']], ignore_index=True), configs.get('NAME_NORMALIZATION'))
+    df_graph['source'] = names[:len(df_graph)].values
+    df_graph['target'] = names[len(df_graph):].values
+
+    # Sweep the thresholds and scorers of the fuzzy matching
+    fuzzy_names = read_fuzzy_names(configs)
+    if configs.get('SWEEP', False) and not fuzzy_names:
+        logger.warning('No canonical names in FUZZY_NAMES for ' + configs['AGENCY'] + ': skipping the sweep.')
+    elif configs.get('SWEEP', False):
+        logger.info('Sweeping fuzzy matching thresholds.')
+        output = '..' + configs['DATA_PATH'] + '/etendering_sweep_' + configs['AGENCY']
+        df_sweep, df_merges = sweep_fuzzy_thresholds(df_graph, fuzzy_names,
+                                                     configs.get('SWEEP_THRESHOLDS', list(range(50, 100, 5))),
+                                                     configs.get('SWEEP_SCORERS', list(FUZZY_SCORERS)),
+                                                     GRAPH_RENAMES.get(configs['AGENCY'], {}),
+                                                     '..' + configs['DATA_PATH'] + '/etendering_similarity_' + configs['AGENCY'])
+        logger.info('\n' + df_sweep.to_string(index=False))
+        df_sweep.to_csv(output + '.csv' + data_extension(configs), index=False)
+        df_merges.to_csv(output + '_merges.csv' + data_extension(configs), index=False)
+
     if configs['AGENCY'] == 'eulisa':
-        df_graph = df_clean_graph_eulisa(df_graph)
+        df_graph = df_clean_graph_eulisa(df_graph, fuzzy_names)
     elif configs['AGENCY'] == 'frontex':
-        df_graph = df_clean_graph_frontext(df_graph)
+        df_graph = df_clean_graph_frontext(df_graph, fuzzy_names)
 
     df_graph = scale_edge_weights(df_graph)
     logger.info('Writing dataset.')
-    df_graph.to_csv('..' + configs['DATA_PATH'] + '/etendering_graph_' + configs['AGENCY'] + '.csv', index=False)
+    df_graph.to_csv('..' + configs['DATA_PATH'] + '/etendering_graph_' + configs['AGENCY'] + '.csv' + data_extension(configs), index=False)
+
+    # Temporal graph: per-year (or cumulative) snapshots of the network
+    if configs.get('TEMPORAL', False):
+        logger.info('Building yearly snapshots of the graph.')
+        years = df_contractors.drop_duplicates('id').set_index('id')['year']
+        df_graph['year'] = df_graph['id_contract'].map(years)
+        df_snapshots, df_deltas = graph_snapshots(df_graph, cumulative=configs.get('CUMULATIVE', False))
+
+        output = '..' + configs['DATA_PATH'] + '/etendering_graph_' + configs['AGENCY'] + '_temporal'
+        df_snapshots.to_csv(output + '.csv' + data_extension(configs), index=False)
+        df_deltas.to_csv(output + '_deltas.csv' + data_extension(configs), index=False)
+        write_gexf_dynamic(df_snapshots, output + '.gexf')
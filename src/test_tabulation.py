@@ -0,0 +1,57 @@
+import os
+import re
+import sys
+
+import pandas as pd
+import pytest
+
+SRC_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SRC_PATH)
+
+from utils import *
+
+CORPUS = os.path.join(SRC_PATH, '..', 'data', 'raw', 'corpus_etendering_eulisa.txt')
+
+
+@pytest.fixture(scope='module')
+def records():
+    with open(CORPUS, encoding='utf-8') as f:
+        corpus = f.read()
+    return [make_json(c) for c in corpus.split('I.II.') if re.search('Contract award notice', c)]
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    # Output paths are '..' + DATA_PATH, relative to the src folder
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'data').mkdir()
+    monkeypatch.chdir(tmp_path / 'src')
+    return {'DATA_PATH': '/data', 'AGENCY': 'eulisa'}
+
+def read_csv_text(path):
+    with open_data(str(path)) as f:
+        return pd.read_csv(f, dtype=str, keep_default_na=False)
+
+@pytest.mark.parametrize('chunksize', [1, 7, 10000])
+def test_chunked_tabulation_matches_full(records, config, tmp_path, chunksize):
+    df_clean = clean_df(json_to_df(records))
+    df_contractors = clean_df_contractors(create_df_contractors(records, df_clean))
+    df_clean.to_csv(tmp_path / 'contracts_full.csv', index=False)
+    df_contractors.to_csv(tmp_path / 'contractors_full.csv', index=False)
+
+    tabulate_chunked(iter(records), config, chunksize)
+
+    for table in ['contracts', 'contractors']:
+        pd.testing.assert_frame_equal(read_csv_text(tmp_path / 'data' / ('etendering_' + table + '_eulisa.csv')),
+                                      read_csv_text(tmp_path / (table + '_full.csv')))
+    assert sorted(os.listdir(tmp_path / 'data')) == ['etendering_contracts_eulisa.csv',
+                                                     'etendering_contractors_eulisa.csv',
+                                                     'etendering_eulisa.json']
+
+def test_chunked_tabulation_removes_outputs_on_failure(records, config, tmp_path):
+    def failing_records():
+        yield from records[:3]
+        raise RuntimeError('Broken record')
+
+    with pytest.raises(RuntimeError):
+        tabulate_chunked(failing_records(), config, 2)
+    assert os.listdir(tmp_path / 'data') == []
@@ -8,6 +8,14 @@ import numpy as np
 import re
 import boto3
 import glob
+import gzip
+import io
+import itertools
+import lzma
+import os
+import textwrap
+import unicodedata
+import xml.etree.ElementTree as ET
 
 # fuzz is used to compare TWO strings
 from fuzzywuzzy import fuzz
@@ -78,16 +86,89 @@ def create_logger(name='Experiment', **kwargs):
 logger=create_logger()
 
 
+# Compressed files are detected from their extension
+COMPRESSION_EXTENSIONS = ['.gz', '.zst', '.xz']
+
+def data_extension(config):
+    """
+    Extension appended to output files, e.g. '.gz' if COMPRESSION is 'gz'.
+    """
+    if config.get('COMPRESSION'):
+        extension = '.' + config['COMPRESSION']
+        if extension not in COMPRESSION_EXTENSIONS:
+            raise ValueError('COMPRESSION must be one of ' + ', '.join(e[1:] for e in COMPRESSION_EXTENSIONS) +
+                             ', got ' + repr(config['COMPRESSION']))
+        return extension
+    return ''
+
+def data_file_candidates(path):
+    """
+    Existing plain and compressed versions of a file.
+    """
+    return [path + e for e in [''] + COMPRESSION_EXTENSIONS if os.path.exists(path + e)]
+
+def find_data_file(path, config=None):
+    """
+    Return the path of the file to read: the one with the extension of
+    COMPRESSION if it exists, otherwise the most recent of the plain
+    and compressed versions of the file.
+    """
+    preferred = path + data_extension(config or {})
+    candidates = data_file_candidates(path)
+    if len(candidates) > 1:
+        logger.warning('Several versions of ' + path + ' exist: ' + ', '.join(candidates) + '.')
+    if preferred in candidates:
+        return preferred
+    if candidates:
+        return max(candidates, key=os.path.getmtime)
+    return preferred
+
+def open_data(path, mode='r'):
+    """
+    Open a text file ('r' or 'w'), streaming the (de)compression
+    according to its extension (.gz, .zst, .xz).
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    if path.endswith('.xz'):
+        return lzma.open(path, mode + 't', encoding='utf-8')
+    if path.endswith('.zst'):
+        import zstandard
+        f = open(path, mode + 'b')
+        if mode == 'r':
+            stream = zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(f, closefd=True)
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+def corpus_path(config):
+    return find_data_file('..' + config['DATA_PATH'] + '/raw/corpus_etendering_' + config['AGENCY'] + '.txt', config)
+
 def read_corpus(config):
     """
     Read corpus of contracts.
     """
     logger.info('Reading corpus of ' + config['AGENCY'] + '.')
-    f = open('..' + config['DATA_PATH'] + '/raw/corpus_etendering_' + config['AGENCY'] + '.txt', 'r')
-    corpus = f.read()
-    f.close()
+    with open_data(corpus_path(config)) as f:
+        corpus = f.read()
     return corpus
 
+def iter_corpus(config, sep='I.II.', block_size=1 << 20):
+    """
+    Stream the corpus of contracts, yielding the same pieces as
+    read_corpus(config).split(sep) without loading the whole file.
+    """
+    logger.info('Reading corpus of ' + config['AGENCY'] + '.')
+    with open_data(corpus_path(config)) as f:
+        buffer = ''
+        for block in iter(lambda: f.read(block_size), ''):
+            pieces = (buffer + block).split(sep)
+            buffer = pieces.pop()
+            for piece in pieces:
+                yield piece
+        yield buffer
+
 # Functions to structure the document into a dictionary file
 def extract_id(text):
     """
@@ -301,12 +382,105 @@ def make_json(text):
             d['award_of_contracts'] = contracts_list
     return d
 
+CPV_LEVELS = {'division': 2, 'group': 3, 'class': 4, 'category': 5}
+
+def parse_cpv_codes(text):
+    """
+    Extract the 8-digit CPV codes of a text, without the check digit.
+    Like '33000000 Medical equipments, ...' or '72000000-5'.
+    """
+    if not isinstance(text, str):
+        return []
+    return re.findall(r'(?<!\d)(\d{8})(?:-\d)?(?!\d)', text)
+
+def load_cpv_index(path):
+    """
+    Load the official CPV hierarchy from a local CSV file
+    (first column the code, second column the description)
+    and index it by prefix for each level of the hierarchy.
+    """
+    df_cpv = pd.read_csv(path, dtype=str, usecols=[0, 1])
+    df_cpv.columns = ['code', 'label']
+    df_cpv['code'] = df_cpv['code'].str.strip().str[:8]
+
+    cpv_index = {level: {} for level in CPV_LEVELS}
+    for code, label in df_cpv.itertuples(index=False):
+        for level, digits in CPV_LEVELS.items():
+            if code[digits:] == '0' * (8 - digits):
+                cpv_index[level][code[:digits]] = (code, label)
+                break
+    return cpv_index
+
+def cpv_rollup(code, cpv_index, level):
+    """
+    Return the code of the CPV level (division/group/class/category) that contains the code.
+    If the prefix is not in the hierarchy (or the code is less specific than the level),
+    the closest coarser level is returned.
+    """
+    for parent, digits in reversed(list(CPV_LEVELS.items())):
+        if digits <= CPV_LEVELS[level] and code[:digits] in cpv_index[parent]:
+            return cpv_index[parent][code[:digits]][0]
+    return 'NA'
+
+def cpv_category(codes, cpv_categories):
+    """
+    Map CPV codes to a user-defined category using the longest matching prefix,
+    e.g. {'48': 'Software', '7972': 'Security services'}.
+    """
+    for code in codes:
+        for digits in range(8, 1, -1):
+            if code[:digits] in cpv_categories:
+                return cpv_categories[code[:digits]]
+    return 'Other'
+
+def read_cpv_categories(config):
+    """
+    User-defined CPV categories of the config, e.g. {'48': 'Software', '03': 'Agriculture'}.
+    Keys must be quoted in the YAML file: unquoted, 03 is read as the number 3.
+    """
+    cpv_categories = config.get('CPV_CATEGORIES') or {}
+    for prefix in cpv_categories:
+        if not isinstance(prefix, str) or not re.fullmatch(r'\d{2,8}', prefix):
+            raise ValueError('CPV_CATEGORIES keys must be quoted CPV prefixes of 2 to 8 digits '
+                             '(e.g. \'03\'), got ' + repr(prefix))
+    return cpv_categories
+
+def add_cpv_columns(df, cpv_index=None, cpv_categories=None):
+    """
+    Attach CPV codes, rollup keys (if the CPV hierarchy is given)
+    and categories as categorical columns.
+    Every key is computed once per distinct code, then mapped back.
+    """
+    codes = [parse_cpv_codes(c) for c in df['cpv']]
+    codes_2 = [parse_cpv_codes(c) for c in df.get('cpv_2', pd.Series('NA', index=df.index))]
+    main_codes = pd.Series([c[0] if c else 'NA' for c in codes], index=df.index)
+
+    df['cpv_code'] = main_codes.astype('category')
+    df['cpv_codes'] = [' '.join(dict.fromkeys(c + c_2)) for c, c_2 in zip(codes, codes_2)]
+
+    unique_codes = df['cpv_code'].cat.categories
+    for level in CPV_LEVELS if cpv_index is not None else []:
+        rollup = {code: cpv_rollup(code, cpv_index, level) for code in unique_codes}
+        df['cpv_' + level] = df['cpv_code'].map(rollup).astype('category')
+
+    if cpv_categories:
+        categories = {key: cpv_category(key.split(), cpv_categories) for key in set(df['cpv_codes'])}
+        df['cpv_category_name'] = df['cpv_codes'].map(categories).astype('category')
+    return df
+
+def cpv_by_year(df, column='cpv_division', value='object_total_value_clean'):
+    """
+    Aggregate the value of contracts by year and CPV level or category,
+    e.g. column='cpv_group' or 'cpv_category_name'.
+    """
+    return df.groupby(['year', column], observed=True)[value].sum().unstack(fill_value=0)
+
 def write_json(json_file, config):
     """
     Write the JSON file.
     """
     logger.info("Corpus succesfully structured. Writing JSON file.")
-    with open('..' + config['DATA_PATH'] + '/etendering_' + config['AGENCY'] + '.json', 'w', encoding='utf-8') as f:
+    with open_data('..' + config['DATA_PATH'] + '/etendering_' + config['AGENCY'] + '.json' + data_extension(config), 'w') as f:
         json.dump(json_file, f, ensure_ascii=False, indent=4)
 
 def json_to_df(json_file):
@@ -326,6 +500,7 @@ def json_to_df(json_file):
     object_description = []
     object_total_value = []
     object_cpv = []
+    object_cpv_2 = []
     #duration only available if year > 2015
 
     procedure_type = []
@@ -348,6 +523,7 @@ def json_to_df(json_file):
         object_description.append(contract[u'object'][u'description'])
         object_total_value.append(contract[u'object'][u'total_value'])
         object_cpv.append(contract[u'object'][u'cpv'])
+        object_cpv_2.append(contract[u'object'].get(u'cpv_2', 'NA'))
         if(int(contract[u'year']) > 2015):
             award_criteria.append(contract[u'object'][u'award_criteria'])
         else:
@@ -359,19 +535,19 @@ def json_to_df(json_file):
     df = pd.DataFrame([ids,years,
                        contracting_authority_official_names, contracting_authority_countries,
                        contracting_authority_nuts, contracting_authority_main_activity,
-                      object_title, object_type, object_description, object_total_value, object_cpv,
+                      object_title, object_type, object_description, object_total_value, object_cpv, object_cpv_2,
                       award_criteria, procedure_type]).T
 
     df.columns = ['id', 'year', 'contracting_authority_official_name', 'contracting_authority_country',
                   'contracting_authority_nut', 'contracting_authority_main_activity',
-                  'object_title', 'object_type', 'object_description', 'object_total_value', 'cpv',
+                  'object_title', 'object_type', 'object_description', 'object_total_value', 'cpv', 'cpv_2',
                   'award_criteria', 'procedure_type']
 
     #Create URL column
     df['url'] = 'https://ted.europa.eu/udl?uri=TED:NOTICE:' + df['id'] + ':TEXT:EN:HTML&src=0'
     return df
 
-def clean_df(df):
+def clean_df(df, cpv_index=None, cpv_categories=None):
     # Clean price
     df['object_total_value_clean'] = df['object_total_value'].str.replace('EUR', '')
     df['object_total_value_clean'] = df['object_total_value_clean'].str.replace(' ', '')
@@ -386,8 +562,14 @@ def clean_df(df):
             df.at[index, 'object_total_value_clean'] = df.at[index, 'object_total_value_clean'].replace(',', '.')
             df.at[index, 'object_total_value_clean'] = float(df.at[index, 'object_total_value_clean'])*0.22
 
-    df_clean = df[df['object_total_value_clean'] != 'NA']
-    df_clean['object_total_value_clean'] = df_clean['object_total_value_clean'].astype(float)
+    # Remove empty rows (dropping them avoids a copy of a slice)
+    keep = df['object_total_value_clean'] != 'NA'
+    df['object_total_value_clean'] = df['object_total_value_clean'].where(keep).astype(float)
+    df_clean = df.drop(index=df.index[~keep])
+
+    # CPV rollup keys and user-defined categories
+    if cpv_index is not None or cpv_categories:
+        df_clean = add_cpv_columns(df_clean, cpv_index, cpv_categories)
     return df_clean
 
 def create_df_contractors(json_file, df_clean):
@@ -422,7 +604,7 @@ def create_df_contractors(json_file, df_clean):
     df_contractors = df_clean.merge(df_contractors, how='right', on='id', validate='one_to_many')
     return df_contractors
 
-def clean_df_contractors(df_contractors):
+def clean_df_contractors(df_contractors, name_options=None):
     # Remove euro string and spaces
     df_contractors['contractors_total_value_clean'] = df_contractors['contractors_total_value'].str.replace('EUR', '')
     df_contractors['contractors_total_value_clean'] = df_contractors['contractors_total_value_clean'].str.replace(' ', '')
@@ -438,7 +620,8 @@ def clean_df_contractors(df_contractors):
             df_contractors.at[index, 'contractors_total_value_clean'] = float(df_contractors.at[index, 'contractors_total_value_clean'])*0.22
 
     # Remove empty rows
-    df_contractors = df_contractors.loc[df_contractors['contractors_total_value_clean'] != 'NA']
+    keep = df_contractors['contractors_total_value_clean'] != 'NA'
+    df_contractors = df_contractors.drop(index=df_contractors.index[~keep])
     # List to string
     df_contractors['contractors_clean'] = [','.join(i) if isinstance(i, list) else i for i in df_contractors['contractors']]
     # Clean names
@@ -451,25 +634,15 @@ def clean_df_contractors(df_contractors):
     # S3B Consortium
     df_contractors.loc[df_contractors['contractors_clean'] == ' Consortium S3B, consisting of Steria Benelux SA/NV (group leader), 3M Belgium BVBA/SPRL, Bull SAS', 'contractors_clean'] = 'S3B Consortium (Steria BE, Bull, Gemalto Cogent)'
     df_contractors.loc[df_contractors['contractors_clean'] == ' Consortium S3B, represented by the group leader Sopra Steria Benelux SA, Consortium S3B, consortium member: Bull SAS, Consortium S3B, consortium member: 3M Belgium BVBA', 'contractors_clean'] = 'S3B Consortium (Steria BE, Bull, Gemalto Cogent)'
-    df_contractors.loc[df_contractors['contractors_clean'] == 'S3B Consortium (Steria BE, Bull, Gemalto Cogent)', 'contractors_clean'] = 'S3B Consortium (Steria BE, Bull, Gemalto Cogent)'
 
     # Infeurope
-    df_contractors.loc[df_contractors['contractors_clean'] == ' Infeurope SA', 'contractors_clean'] = 'Infeurope SA'
-    df_contractors.loc[df_contractors['contractors_clean'] == ' INFEUROPE S.A., imc information multimedia communication AG', 'contractors_clean'] = 'Infeurope SA'
     df_contractors.loc[df_contractors['contractors_clean'] == ' INFEUROPE S.A., imc information multimedia communication AG', 'contractors_clean'] = 'Infeurope SA'
 
-
-    # Infeurope
-    df_contractors.loc[df_contractors['contractors_clean'] == ' AS G4S EESTI', 'contractors_clean'] = 'AS G4S Eesti'
-    df_contractors.loc[df_contractors['contractors_clean'] == ' AS G4S Eesti', 'contractors_clean'] = 'AS G4S Eesti'
-
     # ELIN GmbH
-    df_contractors.loc[df_contractors['contractors_clean'] == ' ELIN GmbH', 'contractors_clean'] = 'ELIN GmbH'
     df_contractors.loc[df_contractors['contractors_clean'] == ' ELIN GmbH & Co KG', 'contractors_clean'] = 'ELIN GmbH'
 
     # Axima Concept
     df_contractors.loc[df_contractors['contractors_clean'] == ' Axima Concept', 'contractors_clean'] = 'Axima Concept SA'
-    df_contractors.loc[df_contractors['contractors_clean'] == ' Axima Concept S.A.', 'contractors_clean'] = 'Axima Concept SA'
 
     # Consortium IBM Belgium BVBA
     df_contractors.loc[df_contractors['contractors_clean'] == ' Consortium IBM Belgium BVBA, Atos Belgium NV and Leonardo S.p.a, represented by the Group Leader IBM Belgium BVBA, Atos Belgium NV, Leonardo S.p.a', 'contractors_clean'] = 'Consortium IBM Belgium BVBA, Atos, and Leonardo'
@@ -477,15 +650,12 @@ def clean_df_contractors(df_contractors):
     # European Dynamics
     df_contractors.loc[df_contractors['contractors_clean'] == ' European Dynamics Luxembourg SA (Group Leader), European Dynamics SA, European Dynamics Belgium SA', 'contractors_clean'] = 'European Dynamics'
 
-    # Car Master
-    df_contractors.loc[df_contractors['contractors_clean'] == ' Car Master 2 Sp. z o.o. Sp.k', 'contractors_clean'] = ' Car Master 2 Sp. z o.o. Sp.k'
-
     # Consortium  CAE Aviation, DEA Aviation Ltd, EASP Air BV
     df_contractors.loc[df_contractors['contractors_clean'] == ' CAE Aviation, DEA Aviation Ltd, EASP Air BV', 'contractors_clean'] = ' CAE Aviation, DEA Aviation, EASP Air BV'
-    df_contractors.loc[df_contractors['contractors_clean'] == ' CAE Aviation, DEA Aviation, EASP Air BV', 'contractors_clean'] = ' CAE Aviation, DEA Aviation, EASP Air BV'
 
-    # Clean first space
-    df_contractors['contractors_clean'] = np.where(df_contractors['contractors_clean'].str[1:] == ' ', df_contractors['contractors_clean'].str[1:], df_contractors['contractors_clean'])
+    # Normalize names: spaces, dashes, legal forms and case
+    # (Infeurope SA, AS G4S Eesti, ELIN GmbH, Axima Concept S.A., ...)
+    df_contractors['contractors_clean'] = normalize_names(df_contractors['contractors_clean'], name_options)
 
     # Create new columns that shows if the contract is related with VIS, EURODAC, or SIS.
 
@@ -501,6 +671,206 @@ def clean_df_contractors(df_contractors):
     df_contractors.contractors_total_value_clean = df_contractors.contractors_total_value_clean.astype(float)
     return df_contractors
 
+# Contractor names normalization
+NAME_NORMALIZATION = {
+    'unicode': True,
+    'whitespace': True,
+    'punctuation': True,
+    'legal_suffixes': True,
+    'casefold': True
+}
+
+NAME_TRANSLATION = str.maketrans({
+    '\u2010': '-', '\u2011': '-', '\u2012': '-', '\u2013': '-', '\u2014': '-', '\u2015': '-', '\u2212': '-',
+    '\u2018': "'", '\u2019': "'", '\u201c': '"', '\u201d': '"',
+    '\u00a0': ' ', '\t': ' ', '\n': ' '
+})
+
+NAME_SPACES = re.compile(r'\s+')
+NAME_DASHES = re.compile(r'\s*-{2,}\s*|\s+-\s*|\s*-\s+')
+NAME_COMMAS = re.compile(r'\s*,\s*')
+NAME_OPEN_BRACKETS = re.compile(r'\(\s+')
+NAME_CLOSE_BRACKETS = re.compile(r'\s+\)')
+
+# Longer dotted forms come first. Short forms do not match when followed by
+# '.' and a letter, so that unknown longer forms (S.A.M.) are left unchanged.
+LEGAL_SUFFIXES = [(re.compile(pattern, re.IGNORECASE), suffix) for pattern, suffix in [
+    (r'(?<![\w.])S\.\s?A\.\s?S\.\s?U\.?(?!\w|\.\w)', 'SASU'),
+    (r'(?<![\w.])S\.\s?A\.\s?R\.\s?L\.?(?!\w|\.\w)', 'SARL'),
+    (r'(?<![\w.])S\.\s?A\.\s?U\.?(?!\w|\.\w)', 'SAU'),
+    (r'(?<![\w.])B\.\s?V\.\s?B\.\s?A\.?(?!\w|\.\w)', 'BVBA'),
+    (r'(?<![\w.])S\.\s?A\.\s?S\.?(?!\w|\.\w)', 'SAS'),
+    (r'(?<![\w.])S\.\s?p\.\s?A\.?(?!\w|\.\w)', 'SpA'),
+    (r'(?<![\w.])S\.\s?R\.\s?L\.?(?!\w|\.\w)', 'SRL'),
+    (r'(?<![\w.])S\.\s?L\.\s?U\.?(?!\w|\.\w)', 'SLU'),
+    (r'(?<![\w.])S\.\s?L\.?(?!\w|\.\w)', 'SL'),
+    (r'(?<![\w.])S\.\s?A\.?(?!\w|\.\w)', 'SA'),
+    (r'(?<![\w.])N\.\s?V\.?(?!\w|\.\w)', 'NV'),
+    (r'(?<![\w.])B\.\s?V\.?(?!\w|\.\w)', 'BV'),
+    (r'(?<![\w.])Ltd\.(?!\w)', 'Ltd'),
+    (r'(?<![\w.])Sp\.?\s+z\s*o\.?\s*o\.?(?!\w)', 'Sp. z o.o.'),
+    (r'\bGmbH\s*&\s*Co\.?\s*KG\b', 'GmbH & Co. KG'),
+    (r'\b(?:SA\s*/\s*NV|NV\s*/\s*SA)\b', 'NV/SA'),
+    (r'\b(?:BVBA\s*/\s*SPRL|SPRL\s*/\s*BVBA)\b', 'BVBA/SPRL')
+]]
+
+def normalize_name(name, options=NAME_NORMALIZATION):
+    """
+    Normalize a contractor name: Unicode forms, quotes and dashes,
+    whitespace and punctuation, and spelling of legal forms.
+    """
+    if not isinstance(name, str):
+        return name
+    if options['unicode']:
+        name = unicodedata.normalize('NFKC', name).translate(NAME_TRANSLATION)
+    if options['punctuation']:
+        name = NAME_DASHES.sub(' - ', name)
+        name = NAME_COMMAS.sub(', ', name)
+        name = NAME_OPEN_BRACKETS.sub('(', name)
+        name = NAME_CLOSE_BRACKETS.sub(')', name)
+    if options['legal_suffixes']:
+        for pattern, suffix in LEGAL_SUFFIXES:
+            name = pattern.sub(suffix, name)
+    if options['whitespace']:
+        name = NAME_SPACES.sub(' ', name).strip()
+    return name
+
+def fold_name(name):
+    """
+    Case-folded name without accents, used to compare names.
+    """
+    name = unicodedata.normalize('NFKD', name.casefold())
+    return ''.join(c for c in name if not unicodedata.combining(c))
+
+def name_key(name):
+    """
+    Key to compare contractor names.
+    """
+    if not isinstance(name, str):
+        return name
+    return fold_name(normalize_name(name))
+
+def map_unique(names, function):
+    """
+    Apply a function once per distinct value of a Series and map the results back.
+    """
+    codes, uniques = pd.factorize(names)
+    values = np.array([function(u) for u in uniques] + [np.nan], dtype=object)
+    return pd.Series(values[codes], index=names.index)
+
+def spelling_rank(name):
+    """
+    Rank of a spelling among the ones that only differ by case or accents
+    (lowest first): fewest words starting with a lower case letter, then
+    fewest capitals inside words, then fewest all-caps words, then lexical order.
+    """
+    words = name.split()
+    lower_initials = sum(1 for word in words if word[:1].islower())
+    inner_capitals = sum(1 for word in words for c in word[1:] if c.isupper())
+    upper_words = sum(1 for word in words if word.isupper())
+    return (lower_initials, inner_capitals, upper_words, name)
+
+def choose_spellings(names):
+    """
+    Spelling of each case-folded key, chosen by spelling_rank.
+    The choice only depends on the set of spellings, not on their frequency or order.
+    """
+    spellings = {}
+    for name in names:
+        if not isinstance(name, str):
+            continue
+        key = fold_name(name)
+        if key not in spellings or spelling_rank(name) < spelling_rank(spellings[key]):
+            spellings[key] = name
+    return spellings
+
+def normalize_names(names, config=None):
+    """
+    Normalize a Series of contractor names.
+    Every distinct name is normalized once. If casefold, names that only differ
+    by case or accents get the same spelling, chosen by choose_spellings.
+    """
+    options = dict(NAME_NORMALIZATION, **(config or {}))
+    codes, uniques = pd.factorize(names)
+    normalized = [normalize_name(u, options) for u in uniques]
+
+    if options['casefold']:
+        spellings = choose_spellings(set(normalized))
+        normalized = [spellings.get(fold_name(name), name) if isinstance(name, str) else name for name in normalized]
+
+    values = np.array(normalized + [np.nan], dtype=object)
+    return pd.Series(values[codes], index=names.index)
+
+def rename_names(names, renames):
+    """
+    Rename the names of a Series, comparing them by name_key.
+    """
+    keys = {name_key(k): v for k, v in renames.items()}
+    return map_unique(names, lambda name: keys.get(name_key(name), name))
+
+def iter_chunks(records, chunksize):
+    """
+    Split an iterable of records into lists of chunksize records.
+    """
+    records = iter(records)
+    chunk = list(itertools.islice(records, chunksize))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(records, chunksize))
+
+def tabulate_chunked(records, config, chunksize, cpv_index=None, cpv_categories=None, name_options=None):
+    """
+    Tabulate the contracts in batches of chunksize records through
+    json_to_df, clean_df, create_df_contractors and clean_df_contractors,
+    appending each batch to the JSON and CSV files.
+    The contractors of a contract are in its record, so each batch is complete.
+    The spelling of the names (see normalize_names) depends on all the names,
+    so it is chosen at the end and applied while copying the contractors
+    from a temporary file: the output is the same as tabulating everything at once.
+    """
+    path = '..' + config['DATA_PATH'] + '/etendering_'
+    extension = data_extension(config)
+    options = dict(NAME_NORMALIZATION, **(name_options or {}))
+    json_path = path + config['AGENCY'] + '.json' + extension
+    contracts_path = path + 'contracts_' + config['AGENCY'] + '.csv' + extension
+    contractors_path = path + 'contractors_' + config['AGENCY'] + '.csv' + extension
+    contractors_tmp = path + 'contractors_' + config['AGENCY'] + '.csv.tmp'
+    names = set()
+    try:
+        with open_data(json_path, 'w') as f_json, \
+             open_data(contracts_path, 'w') as f_contracts, \
+             open_data(contractors_tmp, 'w') as f_contractors:
+            f_json.write('[')
+            for i, chunk in enumerate(iter_chunks(records, chunksize)):
+                logger.info('Tabulating chunk ' + str(i) + ' (' + str(len(chunk)) + ' contracts).')
+                for j, record in enumerate(chunk):
+                    f_json.write(('\n' if i == 0 and j == 0 else ',\n') +
+                                 textwrap.indent(json.dumps(record, ensure_ascii=False, indent=4), '    '))
+
+                df_clean = clean_df(json_to_df(chunk), cpv_index, cpv_categories)
+                df_contractors = clean_df_contractors(create_df_contractors(chunk, df_clean), dict(options, casefold=False))
+                names.update(df_contractors['contractors_clean'].dropna())
+                df_clean.to_csv(f_contracts, index=False, header=(i == 0))
+                df_contractors.to_csv(f_contractors, index=False, header=(i == 0))
+            f_json.write('\n]')
+
+        spellings = choose_spellings(names) if options['casefold'] else {}
+        with open_data(contractors_tmp) as f_tmp, open_data(contractors_path, 'w') as f_contractors:
+            df_chunks = pd.read_csv(f_tmp, dtype=str, keep_default_na=False, chunksize=chunksize) if names else []
+            for i, df_contractors in enumerate(df_chunks):
+                df_contractors['contractors_clean'] = map_unique(df_contractors['contractors_clean'],
+                                                                 lambda name: spellings.get(fold_name(name), name))
+                df_contractors.to_csv(f_contractors, index=False, header=(i == 0))
+    except BaseException:
+        # Do not leave half-written outputs behind
+        for output in [json_path, contracts_path, contractors_path]:
+            if os.path.exists(output):
+                os.remove(output)
+        raise
+    finally:
+        if os.path.exists(contractors_tmp):
+            os.remove(contractors_tmp)
+
 def df_to_graph(df_contractors, ids, source, target, weight):
     """
     Function that transforms df_contractors
@@ -516,7 +886,7 @@ def df_to_graph(df_contractors, ids, source, target, weight):
 
         # to improve code -> if consortium and and -> and is ,
         #contractor = re.sub(r' Consortium U2 — Unisys SA (group leader) and UniSystems Information Technology Systems Commercial SA', 'U2 Consortium Unisys SA (group leader) and UniSystems Information Technology Systems Commercial SA', contractor)
-        if contractor == ' Consortium U2 — Unisys SA (group leader) and UniSystems Information Technology Systems Commercial SA':
+        if contractor == 'Consortium U2 - Unisys SA (group leader) and UniSystems Information Technology Systems Commercial SA':
             contractor = 'U2 Consortium Unisys SA (group leader) and UniSystems Information Technology Systems Commercial SA'
 
         #contractor = re.sub(r'Bridge3 Consortium (Accenture NV/SA, HP Belgium and Morpho)', 'Bridge3 Consortium (Accenture NV/SA, HP Belgium, Morpho)', contractor)
@@ -551,7 +921,6 @@ def df_to_graph(df_contractors, ids, source, target, weight):
                 contractor = re.sub('.*\(?consortium ', '', contractor)
                 contractor = re.sub(r'\(', '', contractor)
                 contractor = re.sub(r'\)', '', contractor)
-                contractor = re.sub('.*\(? —— ', '', contractor)
                 contractor = re.sub('.*\(?consisting of', '', contractor)
                 contractor = re.sub(r'[\(\)]', '', contractor)
                 contractor = re.sub(' with ', ', ', contractor)
@@ -559,7 +928,7 @@ def df_to_graph(df_contractors, ids, source, target, weight):
 
 
             contractor_list = contractor.split(',')
-            contractor_list = [s for s in contractor_list if s != ' ']
+            contractor_list = [s for s in contractor_list if s.strip() != '']
             #contractor_list = [s for s in contractor_list if s != 'Sopra Steria Benelux SA with Bull SAS and 3M Belgium BVBA/SPRL']
 
             for c in range(0, len(contractor_list)-1):
@@ -594,39 +963,250 @@ def clean_fuzzy_names(df, column, contractor, threshold):
     df.update(df_aux)
     return df
 
-def df_clean_graph_eulisa(df_graph):
-    df_graph = clean_fuzzy_names(df_graph, 'source', 'Bull', 60)
-    df_graph = clean_fuzzy_names(df_graph, 'target', 'Bull', 60)
-    df_graph = clean_fuzzy_names(df_graph, 'source', '3M Belgium BVBA', 60)
-    df_graph = clean_fuzzy_names(df_graph, 'target', '3M Belgium BVBA', 60)
-    df_graph = clean_fuzzy_names(df_graph, 'source', 'Sopra Steria', 60)
-    df_graph = clean_fuzzy_names(df_graph, 'target', 'Sopra Steria', 60)
-    df_graph = clean_fuzzy_names(df_graph, 'source', 'Accenture', 70)
-    df_graph = clean_fuzzy_names(df_graph, 'target', 'Accenture', 70)
-    df_graph = clean_fuzzy_names(df_graph, 'source', 'Atos Belgium', 70)
-    df_graph = clean_fuzzy_names(df_graph, 'target', 'Atos Belgium', 70)
-
-    df_graph['source'] = np.where(df_graph['source'] == 'Atos Belgium', 'Atos', df_graph['source'])
-    df_graph['source'] = np.where(df_graph['source'] == ' Atos Integration SAS', 'Atos', df_graph['source'])
-    df_graph['source'] = np.where(df_graph['source'] == ' and Hewlett Packard Belgium BVBA/SPRL ', 'HP Belgium', df_graph['source'])
-    df_graph['source'] = np.where(df_graph['source'] == 'Morpho', 'Idemia', df_graph['source'])
-    df_graph['source'] = np.where(df_graph['source'] == ' Idemia Identity & Security SAS', 'Idemia', df_graph['source'])
-
-    df_graph['target'] = np.where(df_graph['target'] == 'Atos Belgium', 'Atos', df_graph['target'])
-    df_graph['target'] = np.where(df_graph['target'] == ' Atos Integration SAS', 'Atos', df_graph['target'])
-    df_graph['target'] = np.where(df_graph['target'] == ' and Hewlett Packard Belgium BVBA/SPRL ', 'HP Belgium', df_graph['target'])
-    df_graph['target'] = np.where(df_graph['target'] == 'Morpho', 'Idemia', df_graph['target'])
-    df_graph['target'] = np.where(df_graph['target'] == ' Idemia Identity & Security SAS', 'Idemia', df_graph['target'])
-    return df_graph
+# Canonical names and thresholds of the fuzzy matching, applied in order
+FUZZY_NAMES = {
+    'eulisa': [('Bull', 60), ('3M Belgium BVBA', 60), ('Sopra Steria', 60), ('Accenture', 70), ('Atos Belgium', 70)],
+    'frontex': []
+}
+
+# Nodes renamed after the fuzzy matching
+GRAPH_RENAMES = {
+    'eulisa': {
+        'Atos Belgium': 'Atos',
+        'Atos Integration SAS': 'Atos',
+        'and Hewlett Packard Belgium BVBA/SPRL': 'HP Belgium',
+        'Morpho': 'Idemia',
+        'Idemia Identity & Security SAS': 'Idemia'
+    },
+    'frontex': {'DEA Aviation Ltd': 'DEA Aviation'}
+}
+
+FUZZY_SCORERS = {
+    'token_sort_ratio': fuzz.token_sort_ratio,
+    'token_set_ratio': fuzz.token_set_ratio,
+    'ratio': fuzz.ratio,
+    'partial_ratio': fuzz.partial_ratio
+}
+
+def read_fuzzy_names(config):
+    """
+    Fuzzy matching of the agency: FUZZY_NAMES of the config if set
+    (e.g. thresholds calibrated with the sweep), otherwise the defaults.
+    """
+    return [tuple(f) for f in config.get('FUZZY_NAMES', FUZZY_NAMES.get(config['AGENCY'], []))]
+
+def similarity_matrix(names, canonical_names, scorer='token_sort_ratio', cache_path=None):
+    """
+    Scores between every name and every canonical name.
+    Canonical names are rows too, since the passes of clean_fuzzy_names
+    are applied one after the other. The matrix is cached on disk and
+    only the scores of new names and new canonical names are computed.
+    """
+    rows = sorted(set(names) | set(canonical_names))
+    df_scores = pd.DataFrame(dtype=int)
+    if cache_path is not None and os.path.exists(cache_path):
+        df_scores = pd.read_csv(cache_path, index_col=0, dtype=str, keep_default_na=False).astype(int)
+
+    changed = False
+    columns = list(df_scores.columns) + [c for c in canonical_names if c not in df_scores.columns]
+    for column in columns[len(df_scores.columns):]:
+        df_scores[column] = [FUZZY_SCORERS[scorer](n, column) for n in df_scores.index]
+        changed = True
+
+    missing = [n for n in rows if n not in df_scores.index]
+    if missing:
+        logger.info('Scoring ' + str(len(missing)) + ' names with ' + scorer + '.')
+        df_missing = pd.DataFrame([[FUZZY_SCORERS[scorer](n, c) for c in columns] for n in missing],
+                                  index=missing, columns=columns)
+        df_scores = pd.concat([df_scores, df_missing])
+        changed = True
+
+    if changed and cache_path is not None:
+        df_scores.to_csv(cache_path)
+    return df_scores.loc[rows, canonical_names]
+
+def fuzzy_name_mapping(df_scores, fuzzy_names, names):
+    """
+    Mapping name -> name given by the passes of clean_fuzzy_names
+    for fuzzy_names [(canonical name, threshold), ...], read from the scores.
+    """
+    mapping = pd.Series(list(names), index=list(names))
+    for canonical, threshold in fuzzy_names:
+        scores = df_scores[canonical].reindex(mapping.values).values
+        mapping[scores > threshold] = canonical
+    return mapping
 
-def df_clean_graph_frontext(df_graph):
-    df_graph['source'] = np.where(df_graph['source'] == ' Dea Aviation Ltd', ' Dea Aviation', df_graph['source'])
-    df_graph['target'] = np.where(df_graph['target'] == ' Dea Aviation Ltd', ' Dea Aviation', df_graph['target'])
+def sweep_fuzzy_thresholds(df_graph, fuzzy_names, thresholds, scorers, renames=None, cache_prefix=None):
+    """
+    Evaluate the fuzzy matching of the graph names for many thresholds
+    and scorers, from one similarity matrix per scorer.
+    Besides the uniform thresholds, the configured fuzzy_names are evaluated too.
+    The renames applied after the fuzzy matching are applied as well, so that
+    each setting reports the merges made and the number of nodes and
+    (undirected) edges of the graph the pipeline would write.
+    """
+    names = sorted(set(df_graph['source']) | set(df_graph['target']))
+    canonical_names = [c for c, _ in fuzzy_names]
+    settings = [('configured', fuzzy_names)] + [(t, [(c, t) for c in canonical_names]) for t in thresholds]
+    keys = {name_key(k): v for k, v in (renames or {}).items()}
+
+    results = []
+    merges = []
+    for scorer in scorers:
+        cache_path = None if cache_prefix is None else cache_prefix + '_' + scorer + '.csv'
+        df_scores = similarity_matrix(names, canonical_names, scorer, cache_path)
+        for threshold, setting in settings:
+            mapping = fuzzy_name_mapping(df_scores, setting, names)
+            mapping = mapping.map(lambda name: keys.get(name_key(name), name))
+            df_edges = undirected_edges(pd.DataFrame({'source': df_graph['source'].map(mapping).values,
+                                                      'target': df_graph['target'].map(mapping).values}))
+            merged = mapping[mapping.index != mapping.values]
+            results.append([scorer, threshold, len(merged),
+                            len(set(df_edges['source']) | set(df_edges['target'])),
+                            len(set(zip(df_edges['source'], df_edges['target'])))])
+            merges += [[scorer, threshold, n, c] for n, c in merged.items()]
+
+    df_results = pd.DataFrame(results, columns=['scorer', 'threshold', 'merges', 'nodes', 'edges'])
+    df_merges = pd.DataFrame(merges, columns=['scorer', 'threshold', 'name', 'canonical_name'])
+    return df_results, df_merges
+
+def df_clean_graph(df_graph, fuzzy_names, renames):
+    """
+    Merge the names of the graph: fuzzy matching, then renames.
+    """
+    for contractor, threshold in fuzzy_names:
+        df_graph = clean_fuzzy_names(df_graph, 'source', contractor, threshold)
+        df_graph = clean_fuzzy_names(df_graph, 'target', contractor, threshold)
+
+    df_graph['source'] = rename_names(df_graph['source'], renames)
+    df_graph['target'] = rename_names(df_graph['target'], renames)
     return df_graph
 
+def df_clean_graph_eulisa(df_graph, fuzzy_names=FUZZY_NAMES['eulisa']):
+    return df_clean_graph(df_graph, fuzzy_names, GRAPH_RENAMES['eulisa'])
+
+def df_clean_graph_frontext(df_graph, fuzzy_names=FUZZY_NAMES['frontex']):
+    return df_clean_graph(df_graph, fuzzy_names, GRAPH_RENAMES['frontex'])
+
 def scale_edge_weights(df_graph):
     scaler = MinMaxScaler(feature_range=(1, 100))
     df_graph['weight_scale'] = scaler.fit_transform(df_graph['weight'].values.reshape(-1,1))
     df_graph['weight_scale'] = df_graph['weight_scale'].round().astype(int)
 
     return df_graph
+
+def undirected_edges(df_graph):
+    """
+    Put the source and target of every edge in a canonical (sorted) order,
+    since the graph is undirected: A-B and B-A are the same edge.
+    """
+    source = df_graph['source'].astype(str).values
+    target = df_graph['target'].astype(str).values
+    return df_graph.assign(source=np.where(source <= target, source, target),
+                           target=np.where(source <= target, target, source))
+
+def graph_snapshots(df_graph, cumulative=False):
+    """
+    Build per-year snapshots of the graph, one for every year from the first to the last.
+    Each snapshot is derived from the previous one: only the edges
+    of the new year are visited. If cumulative, edge weights are
+    summed over all the years up to the snapshot.
+    Returns the snapshots (year, source, target, weight) and the
+    node/edge deltas between consecutive years.
+    """
+    df_graph = df_graph.dropna(subset=['year'])
+    df_graph = df_graph.astype({'year': int, 'weight': float})
+    df_graph = undirected_edges(df_graph)
+
+    edges = {}
+    nodes = set()
+    snapshots = []
+    deltas = []
+    # Every year between the first and the last one gets a snapshot, so that
+    # years without contracts carry the cumulative state forward (or are empty)
+    df_years = dict(tuple(df_graph.groupby('year', sort=True)))
+    years = range(min(df_years), max(df_years) + 1) if df_years else []
+    for year in years:
+        df_year = df_years.get(year, df_graph.iloc[:0])
+        year_edges = df_year.groupby(['source', 'target'])['weight'].sum().to_dict()
+        year_nodes = set(df_year['source']) | set(df_year['target'])
+
+        if cumulative:
+            edges_added = [e for e in year_edges if e not in edges]
+            edges_removed = []
+            nodes_added = year_nodes - nodes
+            nodes_removed = set()
+            for e, w in year_edges.items():
+                edges[e] = edges.get(e, 0) + w
+            nodes |= nodes_added
+        else:
+            edges_added = [e for e in year_edges if e not in edges]
+            edges_removed = [e for e in edges if e not in year_edges]
+            nodes_added = year_nodes - nodes
+            nodes_removed = nodes - year_nodes
+            edges = year_edges
+            nodes = year_nodes
+
+        df_snapshot = pd.DataFrame([(s, t, w) for (s, t), w in edges.items()],
+                                   columns=['source', 'target', 'weight'])
+        df_snapshot.insert(0, 'year', year)
+        snapshots.append(df_snapshot)
+        deltas.append([year, len(nodes), len(edges),
+                       len(nodes_added), len(nodes_removed),
+                       len(edges_added), len(edges_removed)])
+
+    if snapshots:
+        df_snapshots = pd.concat(snapshots, ignore_index=True)
+    else:
+        df_snapshots = pd.DataFrame(columns=['year', 'source', 'target', 'weight'])
+    df_deltas = pd.DataFrame(deltas, columns=['year', 'nodes', 'edges',
+                                              'nodes_added', 'nodes_removed',
+                                              'edges_added', 'edges_removed'])
+    return df_snapshots, df_deltas
+
+def year_spells(years):
+    """
+    Group a sorted list of years into (start, end) spells of consecutive years.
+    """
+    spells = []
+    for year in years:
+        if spells and spells[-1][1] == year - 1:
+            spells[-1][1] = year
+        else:
+            spells.append([year, year])
+    return spells
+
+def write_gexf_dynamic(df_snapshots, path):
+    """
+    Write the yearly snapshots as a dynamic GEXF file,
+    so that Gephi can replay the evolution of the network.
+    """
+    df_snapshots = undirected_edges(df_snapshots)
+
+    gexf = ET.Element('gexf', {'xmlns': 'http://www.gexf.net/1.2draft', 'version': '1.2'})
+    graph = ET.SubElement(gexf, 'graph', {'mode': 'dynamic', 'defaultedgetype': 'undirected',
+                                          'timeformat': 'integer'})
+    attributes = ET.SubElement(graph, 'attributes', {'class': 'edge', 'mode': 'dynamic'})
+    ET.SubElement(attributes, 'attribute', {'id': 'weight', 'title': 'Weight', 'type': 'double'})
+
+    xml_nodes = ET.SubElement(graph, 'nodes')
+    df_nodes = pd.concat([df_snapshots[['year', 'source']].rename(columns={'source': 'node'}),
+                          df_snapshots[['year', 'target']].rename(columns={'target': 'node'})])
+    for node, years in df_nodes.drop_duplicates().groupby('node')['year']:
+        xml_node = ET.SubElement(xml_nodes, 'node', {'id': node, 'label': node})
+        xml_spells = ET.SubElement(xml_node, 'spells')
+        for start, end in year_spells(sorted(years)):
+            ET.SubElement(xml_spells, 'spell', {'start': str(start), 'end': str(end)})
+
+    xml_edges = ET.SubElement(graph, 'edges')
+    for i, ((source, target), df_edge) in enumerate(df_snapshots.groupby(['source', 'target'])):
+        xml_edge = ET.SubElement(xml_edges, 'edge', {'id': str(i), 'source': source, 'target': target})
+        xml_attvalues = ET.SubElement(xml_edge, 'attvalues')
+        for year, weight in df_edge.sort_values('year')[['year', 'weight']].itertuples(index=False):
+            ET.SubElement(xml_attvalues, 'attvalue', {'for': 'weight', 'value': str(weight),
+                                                      'start': str(year), 'end': str(year)})
+        xml_spells = ET.SubElement(xml_edge, 'spells')
+        for start, end in year_spells(sorted(df_edge['year'])):
+            ET.SubElement(xml_spells, 'spell', {'start': str(start), 'end': str(end)})
+
+    ET.ElementTree(gexf).write(path, encoding='utf-8', xml_declaration=True)